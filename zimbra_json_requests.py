@@ -2,7 +2,13 @@
 # -*- coding: utf-8 -*-
 
 import abc
+import os
 import json
+import time
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import threading
+from collections import OrderedDict
 import requests
 import cPickle
 import hashlib
@@ -50,21 +56,311 @@ class ValidationError(Exception):
     def __init__(self, message):
         super(ValidationError, self).__init__(self, message)
 
+class ZimbraFault(Exception):
+    def __init__(self, code, message=""):
+        self.code = code
+        super(ZimbraFault, self).__init__(code, message)
+
 class Dummy(iZimbra):
     def _serialize(self):
         return {}
-    
+
+##
+# Transports
+
+class iZimbraTransport(object):
+    """Interface for the transports carrying the json requests"""
+    __meta__ = abc.ABCMeta
+
+    @abc.abstractmethod
+    def post(self, url, payload):
+        """Send the json payload. Returns a response with content and status_code"""
+
+    def clone(self):
+        """Returns a transport with the same settings that shares no
+        connections with this one, ie. for use in another process.
+        Transports without connection state can return themselves."""
+        return self
+
+class RequestsTransport(iZimbraTransport):
+    """The default transport, using requests"""
+    def __init__(self, verify=False, session=None):
+        """
+        Keyword arguments:
+        verify  -- verify the servers certificate
+        session -- optional requests.Session, to keep connections alive
+        """
+        self.verify = verify
+        self.session = session
+
+    def post(self, url, payload):
+        if self.session is not None:
+            return self.session.post(url, data=payload, verify=self.verify)
+        return requests.post(url, data=payload, verify=self.verify)
+
+    def clone(self):
+        if self.session is None:
+            return self.__class__(self.verify)
+        return self.__class__(self.verify, session=requests.Session())
+
+class FakeResponse(object):
+    """The parts of a requests response the library uses"""
+    def __init__(self, content, status_code=200):
+        self.content = content
+        self.status_code = status_code
+
+def make_fault(code, text=""):
+    """Returns a zimbra soap fault in json format"""
+    return {"Fault":{"Code":{"Value":"soap:Sender"},
+                     "Reason":{"Text":text or code},
+                     "Detail":{"Error":{"Code":code,"_jsns":"urn:zimbra"}}}}
+
+class FakeTransport(iZimbraTransport):
+    """Answers in-process from canned handlers, no server needed.
+
+    A handler is registered per request name, is called with the request
+    content and the header context, and returns the response body, ie.
+    {"GetFolderResponse": {...}}. A handler can raise ZimbraFault to answer
+    with a fault. Items of a BatchRequest are sent to their own handlers
+    unless a BatchRequest handler is registered.
+
+    Example:
+    fake = FakeTransport({"GetFolderRequest": lambda req, ctx: {"GetFolderResponse": {"folder": []}}})
+    set_default_transport(fake)
+    """
+    def __init__(self, handlers=None):
+        """
+        Keyword arguments:
+        handlers -- dict of request name -> callable(request, context)
+        """
+        self.handlers = dict(handlers or {})
+        self.calls = 0
+        self.change_tokens = {}
+        self._lock = threading.Lock()
+
+    def add_handler(self, name, handler):
+        self.handlers[name] = handler
+
+    def bump(self, account):
+        """Moves the mailbox change token of account forward, for handlers
+        that change the mailbox"""
+        with self._lock:
+            self.change_tokens[account] = self.change_tokens.get(account, 1) + 1
+
+    def _dispatch(self, name, content, context):
+        if name not in self.handlers:
+            raise ZimbraFault("service.UNKNOWN_DOCUMENT", "unknown document: {}".format(name))
+        return self.handlers[name](content, context)
+
+    def _batch(self, content, context):
+        _response = {"_jsns":"urn:zimbra"}
+        for name, items in content.items():
+            if not isinstance(items, list):
+                continue
+            for item in items:
+                try:
+                    _result = self._dispatch(name, item, context)
+                except ZimbraFault as e:
+                    _result = make_fault(e.code, e.args[-1])
+                for rname, rcontent in _result.items():
+                    _rcontent = dict(rcontent, requestId=str(item.get("requestId")))
+                    _response.setdefault(rname, []).append(_rcontent)
+        return {"BatchResponse":_response}
+
+    def post(self, url, payload):
+        with self._lock:
+            self.calls += 1
+        _request = json.loads(payload)
+        _context = _request.get("Header", {}).get("context", {})
+        _body = {}
+        _status = 200
+        for name, content in _request["Body"].items():
+            try:
+                if name == "BatchRequest" and name not in self.handlers:
+                    _body.update(self._batch(content, _context))
+                else:
+                    _body.update(self._dispatch(name, content, _context))
+            except ZimbraFault as e:
+                _body = make_fault(e.code, e.args[-1])
+                _status = 500
+                break
+        _account = _context.get("account", {}).get("_content")
+        _header = {"_jsns":"urn:zimbra"}
+        if _account is not None:
+            _header["change"] = {"token":self.change_tokens.get(_account, 1)}
+        return FakeResponse(json.dumps({"Header":{"context":_header},
+                                        "Body":_body}), _status)
+
+_default_transport = RequestsTransport()
+
+def get_default_transport():
+    return _default_transport
+
+def set_default_transport(transport):
+    """Sets the transport used by requests that are not given one"""
+    global _default_transport
+    _default_transport = transport
+
+##
+# Response cache
+
+class ResponseCache(object):
+    """Size bounded LRU cache for the responses of read-only requests.
+
+    Entries are kept per account, auth token and serialized request, so a
+    response is never served to a request made with another token. Every response
+    passing through a request using the cache carries the mailbox change
+    token of the account, and when that token moves forward all cached
+    entries of the account are dropped. Requests that are not cacheable
+    are assumed to change the mailbox. Changes made by other clients, or
+    delivered mail, are only noticed on the next response seen for the
+    account, so every entry also expires after max_age seconds. Use
+    observe() or invalidate() where that is not soon enough. Thread safe.
+
+    Share info is not cached by default: it follows the grants of the
+    owner, which the change token of the requesting mailbox does not track.
+
+    Example:
+    set_default_cache(ResponseCache())
+    """
+    cacheable = ("GetFolderRequest", "GetInfoRequest", "SearchRequest")
+
+    def __init__(self, max_entries=1000, max_bytes=50 * 1024 * 1024, max_age=30, cacheable=None):
+        """
+        Keyword arguments:
+        max_entries -- max number of cached responses
+        max_bytes   -- max total size of the cached response bodies
+        max_age     -- seconds a response is served from the cache, None for no limit
+        cacheable   -- names of the request classes to cache
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        if cacheable is not None:
+            self.cacheable = tuple(cacheable)
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._keys = {}
+        self._tokens = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def is_cacheable(self, body):
+        return body.__class__.__name__ in self.cacheable
+
+    def _key(self, uid, body, auth):
+        # the token is part of the key, a response is only served again to
+        # requests made with the token it was fetched with
+        return (uid, auth, json.dumps(body._serialize(), sort_keys=True))
+
+    def _drop(self, key):
+        _response, _size, _stored = self._entries.pop(key)
+        self._keys[key[0]].discard(key)
+        self._bytes -= _size
+
+    def get(self, uid, body, auth=None):
+        """Returns the cached response or None"""
+        _key = self._key(uid, body, auth)
+        with self._lock:
+            _entry = self._entries.pop(_key, None)
+            if _entry is None:
+                self.misses += 1
+                return None
+            # re-insert to mark as most recently used
+            self._entries[_key] = _entry
+            if self.max_age is not None and time.time() - _entry[2] > self.max_age:
+                self._drop(_key)
+                self.misses += 1
+                return None
+            self.hits += 1
+            return _entry[0]
+
+    def put(self, uid, body, response, auth=None):
+        _key = self._key(uid, body, auth)
+        _size = len(response.content)
+        if _size > self.max_bytes:
+            return
+        with self._lock:
+            if _key in self._entries:
+                self._drop(_key)
+            self._entries[_key] = (response, _size, time.time())
+            self._keys.setdefault(uid, set()).add(_key)
+            self._bytes += _size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+
+    def observe(self, uid, token):
+        """Registers the change token seen for an account. Returns False if
+        the token is older than one seen before."""
+        token = int(token)
+        with self._lock:
+            _known = self._tokens.get(uid)
+            if _known is not None and token < _known:
+                return False
+            if _known is not None and token > _known:
+                for key in list(self._keys.get(uid, ())):
+                    self._drop(key)
+            self._tokens[uid] = token
+            return True
+
+    def invalidate(self, uid=None):
+        """Drops the cached responses of one account, or everything"""
+        with self._lock:
+            if uid is None:
+                self._entries.clear()
+                self._keys.clear()
+                self._tokens.clear()
+                self._bytes = 0
+                return
+            for key in list(self._keys.get(uid, ())):
+                self._drop(key)
+            self._tokens.pop(uid, None)
+
+    def update(self, uid, body, response, auth=None):
+        """Feeds a fresh response to the cache"""
+        try:
+            _response = json.loads(response.content)
+            _token = _response["Header"]["context"]["change"]["token"]
+        except (ValueError, KeyError, TypeError):
+            _response = None
+            _token = None
+        if _token is None:
+            # nothing to validate against later, do not trust what we have
+            self.invalidate(uid)
+            return
+        _fresh = self.observe(uid, _token)
+        if (not self.is_cacheable(body)) or response.status_code != 200 or "Fault" in _response.get("Body", {}):
+            return
+        if _fresh:
+            self.put(uid, body, response, auth)
+
+_default_cache = None
+
+def get_default_cache():
+    return _default_cache
+
+def set_default_cache(cache):
+    """Sets the ResponseCache used by requests that are not given one.
+    None turns caching off, which is the default."""
+    global _default_cache
+    _default_cache = cache
+
 class ZimbraJSONRequest(iZimbraJSONRequest):
     """Mother for all zimbra requests"""
-    def __init__(self, auth, uid):
+    def __init__(self, auth, uid, transport=None, cache=None):
         """
         Keyword arguments:
-        auth -- the authentication token
-        uid  -- the user ident belonging to the auth token
+        auth      -- the authentication token
+        uid       -- the user ident belonging to the auth token
+        transport -- optional iZimbraTransport, default get_default_transport()
+        cache     -- optional ResponseCache, default get_default_cache()
         """
         self._Body = Dummy()
         self.auth = auth
         self.uid = uid
+        self.transport = transport
+        self.cache = cache
         super(ZimbraJSONRequest, self).__init__()
 
     def clean(self):
@@ -89,10 +385,23 @@ class ZimbraJSONRequest(iZimbraJSONRequest):
                  },
                 "Body":self.Body._serialize()}
 
-    def request(self):
+    def _post(self):
         _payload = json.dumps(self._serialize())
-        _req = requests.post(settings.ZIMBRA_ADMIN_URL+self.Body.__class__.__name__,
-                             data=_payload, verify=False)
+        _transport = self.transport or get_default_transport()
+        _req = _transport.post(settings.ZIMBRA_ADMIN_URL+self.Body.__class__.__name__,
+                               _payload)
+        return _req
+
+    def request(self):
+        _cache = self.cache or get_default_cache()
+        if _cache is None:
+            return self._post()
+        if _cache.is_cacheable(self.Body):
+            _cached = _cache.get(self.uid, self.Body, self.auth)
+            if _cached is not None:
+                return _cached
+        _req = self._post()
+        _cache.update(self.uid, self.Body, _req, self.auth)
         return _req
 
 ##
@@ -121,8 +430,12 @@ def compute_preauth(account, preauthkey, by='name', expires=0, timestamp=None):
     return pkey
 
 class ZimbraAuthRequest(ZimbraJSONRequest):
-    def __init__(self):
-        pass
+    def __init__(self, transport=None):
+        self.transport = transport
+
+    def request(self):
+        # authentication is never cached
+        return self._post()
 
     def _serialize(self):
         return {"Header":
@@ -213,6 +526,17 @@ class CreateContactRequest(object):
     def add_to_batch(self, contact):
         self._contact.append(contact)
 
+    def rebatch(self, contacts):
+        """Returns a new request with only the given contacts"""
+        _new = self.__class__()
+        for contact in contacts:
+            _new.add_to_batch(contact)
+        return _new
+
+    @property
+    def items(self):
+        return self._contact
+
     @property
     def contact(self):
         return self._contact
@@ -546,22 +870,24 @@ class GetDistributionListRequest(object):
 
 class CreateMountpointRequest(object):
     """Creates a named mount for the given zimbra id"""
-    def __init__(self, display_name, zimbra_id, rid, color):
+    def __init__(self, display_name, zimbra_id, rid, color, name=None):
         """
         Keyword arguments:
         display_name -- the mount name
         zimbra_id    -- the id of the account where the mount shuld be created
         rid          -- the id of the shared item
         color        -- one of [1|2|...|9|...]
+        name         -- the full name of the mount, default "<display_name>'s Calendar"
         """
         self.display_name = display_name
         self.zimbra_id = zimbra_id
         self.rid = rid
         self.color = color
+        self.name = name
 
     def _serialize(self):
         return {self.__class__.__name__:{"_jsns":"urn:zimbraMail",
-                                         "link":{"name":u"{}'s Calendar".format(self.display_name),
+                                         "link":{"name":self.name or u"{}'s Calendar".format(self.display_name),
                                                  "zid":self.zimbra_id,
                                                  "rid":self.rid,
                                                  "color":self.color,
@@ -570,6 +896,42 @@ class CreateMountpointRequest(object):
                                          }
                 }
 
+class BatchRequest(object):
+    """Sends any number of requests to the same account in one round-trip.
+    Each item is tagged with its position in the batch as requestId"""
+    def __init__(self, onerror="continue"):
+        """
+        Keyword arguments:
+        onerror -- one of [continue | stop]
+        """
+        self.onerror = onerror
+        self._items = []
+        super(BatchRequest,self).__init__()
+
+    def add_to_batch(self, item):
+        self._items.append(item)
+
+    def rebatch(self, items):
+        """Returns a new batch with only the given items"""
+        _new = self.__class__(self.onerror)
+        for item in items:
+            _new.add_to_batch(item)
+        return _new
+
+    @property
+    def items(self):
+        return self._items
+
+    def _serialize(self):
+        _body = {"_jsns":"urn:zimbra",
+                 "onerror":self.onerror}
+        for i, item in enumerate(self.items):
+            for name, content in item._serialize().items():
+                _content = dict(content)
+                _content["requestId"] = i
+                _body.setdefault(name, []).append(_content)
+        return {self.__class__.__name__:_body}
+
 class SearchDirectoryRequest(object):
     def __init__(self, offset=0, limit=100, query="", qtype="resources"):
         """Set up a search for non system accounts only
@@ -610,7 +972,10 @@ def get_auth_token(uid, pkey, admin=False):
     _za = ZimbraAuthRequest()
     _za.Body = AuthRequest(uid, pkey, admin)
     _res = _za.request()
-    _authToken = json.loads(_res.content)["Body"]["AuthResponse"]["authToken"][0]["_content"]
+    _body = json.loads(_res.content)["Body"]
+    if "Fault" in _body:
+        raise ZimbraFault(fault_code(_body["Fault"]), _body["Fault"].get("Reason", {}).get("Text", uid))
+    _authToken = _body["AuthResponse"]["authToken"][0]["_content"]
     return (_authToken, uid)
 
 def get_all_zimbra_contacts(auth, uid, offset=0, limit=100, cache=None):
@@ -714,3 +1079,612 @@ def md5_hash_zimbra_contact(zimbra_contact):
     return hashlib.md5(cPickle.dumps(zimbra_contact)).hexdigest()
 
 
+##
+# Sharded job runner
+##
+
+class JobJournal(object):
+    """Append-only journal recording per-account completion of a job.
+    One json document per line, the last entry for an account wins.
+    Accounts marked "done" are skipped when an interrupted job is resumed,
+    failed accounts are tried again.
+    """
+    def __init__(self, path):
+        """
+        Keyword arguments:
+        path -- the journal file, created if missing
+        """
+        self.path = path
+        self._state = {}
+        if os.path.exists(path):
+            with open(path, "rb+") as _fh:
+                _data = _fh.read()
+                _end = _data.rfind(b"\n") + 1
+                if _end != len(_data):
+                    # torn last line from a crashed run, cut it off so the
+                    # next record starts on a line of its own
+                    _fh.truncate(_end)
+            for line in _data[:_end].splitlines():
+                try:
+                    _entry = json.loads(line.decode("utf-8"))
+                except ValueError:
+                    continue
+                self._state[_entry["account"]] = _entry["status"]
+        self._fh = open(path, "a")
+
+    def completed(self):
+        """Returns the set of accounts already done"""
+        return set(k for k, v in self._state.items() if v == "done")
+
+    def record(self, account, status, error=None):
+        """Write the status of an account and flush it to disk"""
+        _entry = {"account":account, "status":status, "ts":time.time()}
+        if error is not None:
+            _entry["error"] = error
+        self._fh.write(json.dumps(_entry) + "\n")
+        self._fh.flush()
+        self._state[account] = status
+
+    def close(self):
+        self._fh.close()
+
+AUTH_FAULT_CODES = set(["service.AUTH_EXPIRED",
+                        "service.AUTH_REQUIRED"])
+
+class _AuthWatchTransport(iZimbraTransport):
+    """Wraps the transport of a job worker and notes when the server
+    answers with an auth fault"""
+    def __init__(self, transport):
+        self.transport = transport
+        self.expired = False
+
+    def clone(self):
+        return self.__class__(self.transport.clone())
+
+    def post(self, url, payload):
+        _res = self.transport.post(url, payload)
+        if _res.status_code != 200:
+            try:
+                _fault = json.loads(_res.content)["Body"]["Fault"]
+            except (ValueError, KeyError, TypeError):
+                return _res
+            if fault_code(_fault) in AUTH_FAULT_CODES:
+                self.expired = True
+        return _res
+
+_job_worker = None
+
+def _job_worker_init(uid, pkey, admin, job):
+    """Runs once in every worker process. Each worker authenticates on
+    its own so no token or connection is shared between processes.
+    A failed authentication is not raised here, the pool would restart
+    the worker forever, it is retried and reported per account instead.
+    The transport is cloned so no connection inherited from the parent is
+    shared with other workers."""
+    global _job_worker
+    _watch = _AuthWatchTransport(get_default_transport().clone())
+    set_default_transport(_watch)
+    _job_worker = {"credentials":(uid, pkey, admin),
+                   "job":job,
+                   "auth":None,
+                   "watch":_watch}
+    try:
+        _job_worker_auth()
+    except Exception as e:
+        logger.error("job worker authentication failed: {0!r}".format(e))
+
+def _job_worker_auth():
+    """Returns the token of the worker, authenticating again when there is
+    none yet or the server has reported it expired"""
+    if _job_worker["auth"] is None or _job_worker["watch"].expired:
+        _job_worker["auth"] = None
+        _job_worker["watch"].expired = False
+        _job_worker["auth"], _ = get_auth_token(*_job_worker["credentials"])
+    return _job_worker["auth"]
+
+def _job_worker_run(account):
+    _watch = _job_worker["watch"]
+    _start = time.time()
+    _result = None
+    _error = None
+    for attempt in range(2):
+        try:
+            _result = _job_worker["job"](_job_worker_auth(), account)
+            _error = None
+        except Exception as e:
+            _error = repr(e)
+        if not _watch.expired:
+            break
+        # the token expired while the job ran, run it again with a fresh one
+        _error = _error or "auth token expired"
+    if _error is None:
+        return (account, True, _result, time.time() - _start)
+    return (account, False, _error, time.time() - _start)
+
+def run_sharded_job(job, accounts, journal_path, uid=None, pkey=None, admin=True,
+                    processes=None, chunksize=10):
+    """Runs job(auth, account) for every account, sharded across a pool of
+    worker processes. Completion is recorded per account in a journal so
+    that running the same job again resumes where it stopped.
+
+    The job must be a module level function (it is pickled to the workers)
+    and its return value must be picklable. Helpers taking (auth, uid), like
+    delete_all_zimbra_contacts, can be used as is. When the server reports
+    the token as expired the worker authenticates again and runs the job
+    for that account once more, so jobs should be safe to repeat.
+
+    The credentials are checked once before any worker is started, bad
+    credentials raise ZimbraFault right away.
+
+    Example:
+    report = run_sharded_job(delete_all_zimbra_contacts, accounts, "/tmp/cleanup.journal")
+
+    Keyword arguments:
+    job          -- callable(auth, account)
+    accounts     -- the account names to work on
+    journal_path -- file used to checkpoint progress
+    uid          -- the uid each worker authenticates as, default settings.UID
+    pkey         -- pre auth key or password, default settings.PASSWD
+    admin        -- False or True
+    processes    -- number of worker processes, default one per core
+    chunksize    -- number of accounts handed to a worker at a time
+
+    Returns a dict with the results and errors keyed by account, and metrics.
+    """
+    uid = uid or settings.UID
+    pkey = pkey or settings.PASSWD
+    # fail fast on bad credentials, the workers authenticate on their own
+    get_auth_token(uid, pkey, admin)
+    accounts = list(accounts)
+    _journal = JobJournal(journal_path)
+    _done = _journal.completed()
+    _pending = [a for a in accounts if a not in _done]
+    _results = {}
+    _failed = {}
+    _busy = 0.0
+    _start = time.time()
+    _pool = multiprocessing.Pool(processes, _job_worker_init, (uid, pkey, admin, job))
+    try:
+        for account, ok, result, elapsed in _pool.imap_unordered(_job_worker_run, _pending, chunksize):
+            _busy += elapsed
+            if ok:
+                _journal.record(account, "done")
+                _results[account] = result
+            else:
+                _journal.record(account, "failed", error=result)
+                _failed[account] = result
+                logger.warning("{0} : {1}".format(account, result))
+        _pool.close()
+    except BaseException:
+        _pool.terminate()
+        raise
+    finally:
+        _pool.join()
+        _journal.close()
+
+    _wall = time.time() - _start
+    _processed = len(_results) + len(_failed)
+    return {"results":_results,
+            "failed":_failed,
+            "metrics":{"total":len(accounts),
+                       "skipped":len(accounts) - len(_pending),
+                       "done":len(_results),
+                       "failed":len(_failed),
+                       "wall_seconds":_wall,
+                       "busy_seconds":_busy,
+                       "accounts_per_second":_processed / _wall if _wall else 0.0,
+                       "mean_seconds":_busy / _processed if _processed else 0.0}}
+
+
+##
+# Batch results
+##
+
+RETRYABLE_FAULT_CODES = set(["service.TEMPORARILY_UNAVAILABLE",
+                             "service.RESOURCE_UNREACHABLE",
+                             "mail.MAINTENANCE"])
+
+def fault_code(fault):
+    """Returns the zimbra error code of a fault, ie. mail.MAINTENANCE"""
+    return fault.get("Detail", {}).get("Error", {}).get("Code")
+
+class BatchResponse(object):
+    """Maps the results of a batch back to the items that were sent.
+
+    Attributes:
+      successes  -- list of (item, response)
+      faults     -- list of (item, fault)
+      unanswered -- items the server never got to (onerror "stop")
+    """
+    def __init__(self, batch, response=None):
+        """
+        Keyword arguments:
+        batch    -- the CreateContactRequest, BatchRequest, ... that was sent
+        response -- the decoded json response, None for an empty result
+        """
+        self.batch = batch
+        self.successes = []
+        self.faults = []
+        self.unanswered = []
+        if response is None:
+            return
+        _body = response["Body"]
+        if "Fault" in _body:
+            # the request failed as a whole, ie. an expired auth token
+            self.faults = [(item, _body["Fault"]) for item in batch.items]
+            return
+        _answered = set()
+        for name, value in _body.get("BatchResponse", {}).items():
+            if not isinstance(value, list):
+                continue
+            for result in value:
+                _id = int(result["requestId"])
+                _answered.add(_id)
+                if name == "Fault":
+                    self.faults.append((batch.items[_id], result))
+                else:
+                    self.successes.append((batch.items[_id], result))
+        self.unanswered = [item for i, item in enumerate(batch.items) if i not in _answered]
+
+def send_batch(auth, uid, batch):
+    """Sends a batch request and returns a BatchResponse
+
+    Keyword arguments:
+    auth  -- the auth token
+    uid   -- the account the batch is run on
+    batch -- CreateContactRequest, BatchRequest or anything with items
+    """
+    _req = ZimbraJSONRequest(auth, uid)
+    _req.Body = batch
+    return BatchResponse(batch, json.loads(_req.request().content))
+
+def send_batch_with_retry(auth, uid, batch, retries=3, retryable=None, backoff=1.0, on_fault=None):
+    """Sends a batch and re-sends only the items that failed with a
+    retryable fault, or were never answered, until they succeed or the
+    retries are used up.
+
+    Example:
+    cr = CreateContactRequest()
+    cr.contact = c1
+    cr.contact = c2
+    result = send_batch_with_retry(admin_token, user_address, cr)
+    for contact, fault in result.faults:
+        ...
+
+    Keyword arguments:
+    auth      -- the auth token
+    uid       -- the account the batch is run on
+    batch     -- CreateContactRequest, BatchRequest or anything with items and rebatch()
+    retries   -- max number of re-sends
+    retryable -- fault codes, or callable(fault), deciding if a fault is worth
+                 retrying. Defaults to RETRYABLE_FAULT_CODES
+    backoff   -- seconds to wait before the first retry, doubled for every retry
+    on_fault  -- optional callable(item, fault) called for every item given up on.
+                 Items still unanswered get a fault with the code batch.UNANSWERED
+
+    Transport errors and responses that are not json fail the attempt as a
+    whole and are always retried. When the retries are used up the items
+    get a fault with the code batch.TRANSPORT_ERROR, nothing is raised.
+
+    Returns a BatchResponse covering every item of the original batch.
+    """
+    if retryable is None:
+        retryable = RETRYABLE_FAULT_CODES
+    if not callable(retryable):
+        _codes = set(retryable)
+        retryable = lambda fault: fault_code(fault) in _codes
+
+    _total = BatchResponse(batch)
+    _pending = batch
+    for attempt in range(retries + 1):
+        _broken = False
+        try:
+            _result = send_batch(auth, uid, _pending)
+        except (IOError, ValueError, KeyError) as e:
+            # connection errors, or a proxy error page instead of json. The
+            # whole attempt failed, keep what earlier attempts achieved
+            logger.warning("{0} : batch attempt failed: {1!r}".format(uid, e))
+            _broken = True
+            _fault = make_fault("batch.TRANSPORT_ERROR", repr(e))["Fault"]
+            _result = BatchResponse(_pending)
+            _result.faults = [(item, _fault) for item in _pending.items]
+        _total.successes.extend(_result.successes)
+        _retry = list(_result.unanswered)
+        _failed = []
+        for item, fault in _result.faults:
+            if _broken or retryable(fault):
+                _retry.append(item)
+            _failed.append((item, fault))
+        if not _retry or attempt == retries:
+            _total.faults.extend(_failed)
+            _total.unanswered.extend(_result.unanswered)
+            break
+        _retry_ids = set(id(item) for item in _retry)
+        _total.faults.extend(f for f in _failed if id(f[0]) not in _retry_ids)
+        logger.warning("{0} : retrying {1} of {2} batch items".format(
+            uid, len(_retry), len(_pending.items)))
+        time.sleep(backoff * 2 ** attempt)
+        _pending = _pending.rebatch(_retry)
+
+    if on_fault is not None:
+        for item, fault in _total.faults:
+            on_fault(item, fault)
+        for item in _total.unanswered:
+            on_fault(item, make_fault("batch.UNANSWERED", "no response for the item after the last retry")["Fault"])
+    return _total
+
+##
+# Share provisioning
+##
+
+def get_share_info(auth, uid, owner, cache=None):
+    """Returns the shares made by owner that are visible to uid.
+
+    Keyword arguments:
+    auth  -- the auth token
+    uid   -- the account the shares are resolved for
+    owner -- the name of the share owner
+    cache -- optional dict, shares are looked up and stored per (owner, uid)
+    """
+    if cache is not None and (owner, uid) in cache:
+        return cache[(owner, uid)]
+    _req = ZimbraJSONRequest(auth, uid)
+    _req.Body = GetShareInfoRequest(owner)
+    _body = json.loads(_req.request().content)["Body"]
+    if "Fault" in _body:
+        raise ZimbraFault(fault_code(_body["Fault"]), _body["Fault"].get("Reason", {}).get("Text", owner))
+    _shares = _body["GetShareInfoResponse"].get("share", [])
+    if cache is not None:
+        cache[(owner, uid)] = _shares
+    return _shares
+
+def _walk_links(folders):
+    for folder in folders:
+        for link in folder.get("link", []):
+            yield link
+        for link in _walk_links(folder.get("folder", [])):
+            yield link
+
+def get_folder_tree(auth, uid):
+    """Returns the folder tree of uid, starting with the root folder"""
+    _req = ZimbraJSONRequest(auth, uid)
+    _req.Body = GetFolderRequest()
+    _body = json.loads(_req.request().content)["Body"]
+    if "Fault" in _body:
+        raise ZimbraFault(fault_code(_body["Fault"]), _body["Fault"].get("Reason", {}).get("Text", uid))
+    return _body["GetFolderResponse"].get("folder", [])
+
+def get_mounted_shares(auth, uid, folders=None):
+    """Returns the set of (owner zimbraId, remote folder id) already
+    mounted somewhere in the folder tree of uid"""
+    if folders is None:
+        folders = get_folder_tree(auth, uid)
+    return set((link.get("zid"), str(link.get("rid"))) for link in _walk_links(folders))
+
+def _mount_name(share, owner, used):
+    """Unique name for a mount in the root folder, ie. "Room's Calendar" or
+    "Room's Calendar (12)" when that name is taken. used is updated."""
+    _path = (share.get("folderPath") or share.get("folderName") or "Calendar").strip("/")
+    _base = u"{}'s {}".format(share.get("ownerName") or owner, _path.replace("/", " "))
+    _name = _base
+    i = 0
+    while _name.lower() in used:
+        i += 1
+        _name = u"{} ({}{})".format(_base, share.get("folderId"), "" if i == 1 else "-{}".format(i))
+    used.add(_name.lower())
+    return _name
+
+def provision_mountpoints(auth, uid, graph, view="appointment", color="1",
+                          batch_size=50, concurrency=8, share_cache=None, same_grants=False):
+    """Makes sure every grantee has a mountpoint for the shares of its owners.
+
+    Share info is resolved once per owner and grantee, existing mounts are
+    read from the grantees folder tree and only the missing mountpoints are
+    created, in batches, with the grantees handled concurrently. Mounts are
+    named after the owner and the shared folder and are made unique within
+    the root folder.
+
+    Example:
+    provision_mountpoints(admin_token, a_uid,
+                          {"room1@one.com": ["some@one.com", "other@one.com"]})
+
+    Keyword arguments:
+    auth        -- the admin auth token
+    uid         -- the admin uid
+    graph       -- dict of owner name -> list of grantee names
+    view        -- only shares of this type are mounted, None for all
+    color       -- the color of the new mountpoints
+    batch_size  -- max number of mountpoints created per request
+    concurrency -- number of accounts worked on at the same time
+    share_cache -- optional dict of (owner, grantee) -> shares kept between runs
+    same_grants -- True if every grantee of an owner has the same grants, ie.
+                   the shares are granted to a group or everyone. Share info is
+                   then resolved once per owner, for the first grantee
+
+    Returns a dict of grantee -> {"created", "existing", "failed"}, where
+    existing counts the wanted mounts that were already there and failed
+    lists (owner zimbraId, remote folder id, fault code) for every mount
+    that could not be created. A share lookup or folder tree that failed
+    is listed as (owner or grantee name, None, fault code).
+    """
+    if share_cache is None:
+        share_cache = {}
+    _owners = {}
+    for owner, grantees in graph.items():
+        for grantee in grantees:
+            _owners.setdefault(grantee, []).append(owner)
+
+    def _resolver(owner, grantee):
+        return graph[owner][0] if same_grants else grantee
+
+    _pool = ThreadPool(concurrency)
+    try:
+        _unresolved = set((o, _resolver(o, g)) for g in _owners for o in _owners[g])
+        _unresolved = [x for x in _unresolved if x not in share_cache]
+        # lookups that failed are kept apart, they are not worth caching
+        _share_faults = {}
+
+        def _resolve(key):
+            try:
+                return key, get_share_info(auth, key[1], key[0]), None
+            except ZimbraFault as e:
+                logger.warning("{0} : share info for {1} failed: {2}".format(key[1], key[0], e.code))
+                return key, None, e.code
+
+        for key, shares, code in _pool.map(_resolve, _unresolved):
+            if code is None:
+                share_cache[key] = shares
+            else:
+                _share_faults[key] = code
+
+        def _provision(grantee):
+            _failed = []
+            for owner in _owners[grantee]:
+                _code = _share_faults.get((owner, _resolver(owner, grantee)))
+                if _code is not None:
+                    _failed.append((owner, None, _code))
+            try:
+                _folders = get_folder_tree(auth, grantee)
+            except ZimbraFault as e:
+                logger.warning("{0} : folder tree failed: {1}".format(grantee, e.code))
+                _failed.append((grantee, None, e.code))
+                return (grantee, {"created":0, "existing":0, "failed":_failed})
+            _existing = get_mounted_shares(auth, grantee, _folders)
+            _used = set()
+            for root in _folders:
+                for item in root.get("folder", []) + root.get("link", []):
+                    _used.add(item.get("name", "").lower())
+            _wanted = []
+            _seen = set()
+            _skipped = 0
+            for owner in _owners[grantee]:
+                for share in share_cache.get((owner, _resolver(owner, grantee)), []):
+                    if view is not None and share.get("view") != view:
+                        continue
+                    _key = (share.get("ownerId"), str(share.get("folderId")))
+                    if _key in _seen:
+                        continue
+                    _seen.add(_key)
+                    if _key in _existing:
+                        _skipped += 1
+                        continue
+                    _wanted.append(CreateMountpointRequest(share.get("ownerName") or owner,
+                                                           share.get("ownerId"),
+                                                           share.get("folderId"),
+                                                           color,
+                                                           name=_mount_name(share, owner, _used)))
+            _created = 0
+
+            def _mount_failed(mount, fault):
+                # faults and mounts left unanswered both end up here
+                _failed.append((mount.zimbra_id, mount.rid, fault_code(fault)))
+                logger.warning("{0} : mountpoint {1}:{2} failed: {3}".format(
+                    grantee, mount.zimbra_id, mount.rid, fault_code(fault)))
+
+            for i in range(0, len(_wanted), batch_size):
+                _batch = BatchRequest()
+                for mount in _wanted[i:i + batch_size]:
+                    _batch.add_to_batch(mount)
+                _result = send_batch_with_retry(auth, grantee, _batch, on_fault=_mount_failed)
+                _created += len(_result.successes)
+            return (grantee, {"created":_created,
+                              "existing":_skipped,
+                              "failed":_failed})
+
+        return dict(_pool.map(_provision, list(_owners)))
+    finally:
+        _pool.close()
+        _pool.join()
+
+
+##
+# Sharded directory search
+##
+
+SHARD_ALPHABET = "abcdefghijklmnopqrstuvwxyz0123456789"
+
+def _shard_filter(attr, prefix, rest):
+    """ldap filter for a key range shard.
+    A shard covers every key starting with prefix. A rest shard covers the
+    keys starting with prefix that are not followed by a SHARD_ALPHABET
+    character, ie. what is left over after splitting prefix further.
+    """
+    if not rest:
+        return "({0}={1}*)".format(attr, prefix)
+    _children = "".join("({0}={1}{2}*)".format(attr, prefix, c) for c in SHARD_ALPHABET)
+    if not prefix:
+        return "(!(|{0}))".format(_children)
+    return "(&({0}={1}*)(!(|{2})))".format(attr, prefix, _children)
+
+def _split_shard(prefix):
+    return [(prefix + c, False) for c in SHARD_ALPHABET] + [(prefix, True)]
+
+def _directory_entries(response):
+    return [(kind, entry) for kind, value in response.items()
+            if isinstance(value, list) for entry in value]
+
+def iter_admin_resources_sharded(auth, uid, query="", qtype="accounts", attr="uid",
+                                 limit=500, max_depth=3, concurrency=8):
+    """Parallel alternative to get_all_admin_resources for large directories.
+
+    The search is split into disjoint key ranges on attr (a*, b*, ..., and
+    the rest). The ranges are searched concurrently and any range that still
+    reports more results, or hits the directory search limit, is split on the
+    next character. Ranges at max_depth are paged serially.
+
+    Example:
+    for kind, entry in iter_admin_resources_sharded(admin_token, a_uid):
+        print entry["name"]
+
+    Keyword arguments:
+    auth        -- the admin auth token
+    uid         -- the admin uid
+    query       -- ldap query formated string ie. '(sn=<something>)'
+    qtype       -- one of [resources | accounts | aliases | ...]
+    attr        -- the attribute the key ranges are made on, ie. uid or mail
+    limit       -- page size of every shard
+    max_depth   -- max length of a key prefix
+    concurrency -- number of shards searched at the same time
+
+    Yields (type, entry) tuples, every entry once, in no particular order.
+    """
+    def _fetch(shard):
+        prefix, rest = shard
+        _query = query + _shard_filter(attr, prefix, rest)
+        _search = ZimbraJSONRequest(auth, uid)
+        _search.Body = SearchDirectoryRequest(offset=0, limit=limit, query=_query, qtype=qtype)
+        _body = json.loads(_search.request().content)["Body"]
+        _splittable = not rest and len(prefix) < max_depth
+        if "Fault" in _body:
+            _code = fault_code(_body["Fault"])
+            if _code == "account.TOO_MANY_SEARCH_RESULTS" and _splittable:
+                return [], _split_shard(prefix)
+            raise ZimbraFault(_code, _body["Fault"].get("Reason", {}).get("Text", _query))
+        _response = _body["SearchDirectoryResponse"]
+        _entries = _directory_entries(_response)
+        if _response.get("more"):
+            if _splittable:
+                return _entries, _split_shard(prefix)
+            for page in get_all_admin_resources(auth, uid, offset=limit, limit=limit,
+                                                query=_query, qtype=qtype):
+                _entries.extend(_directory_entries(page["Body"]["SearchDirectoryResponse"]))
+        return _entries, []
+
+    _seen = set()
+    _pool = ThreadPool(concurrency)
+    try:
+        _shards = _split_shard("")
+        while _shards:
+            _next = []
+            for entries, children in _pool.imap_unordered(_fetch, _shards):
+                _next.extend(children)
+                for kind, entry in entries:
+                    # entries of a split shard are searched again by its children
+                    if entry.get("id") in _seen:
+                        continue
+                    _seen.add(entry.get("id"))
+                    yield kind, entry
+            _shards = _next
+    finally:
+        _pool.close()
+        _pool.join()
@@ -0,0 +1,336 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Load generator for capacity testing a Zimbra server with zimbra_json_requests.
+
+Replays a weighted mix of operations, either as fast as the given number of
+workers allow or at a target rate, and reports throughput, latency
+percentiles and error rates every interval.
+
+Example:
+./zimbra_loadgen.py --account some@one.com --mix search=5,dirsearch=2,contacts=1 --concurrency 16
+./zimbra_loadgen.py --mock --mock-latency 20 --rate 200 --duration 30
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import math
+import random
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import requests
+import settings
+import zimbra_json_requests as zjr
+
+__author__ = "Rune Hansen"
+__copyright__ = "Copyright 2013, Redpill Linpro AS"
+__credits__ = []
+__license__ = "GPLv3"
+__version__ = "1.2"
+
+
+class OperationError(Exception):
+    pass
+
+def _check(response):
+    """Raises OperationError on http errors and soap faults, returns the body"""
+    _body = json.loads(response.content)["Body"]
+    if "Fault" in _body:
+        raise OperationError(zjr.fault_code(_body["Fault"]))
+    if response.status_code != 200:
+        raise OperationError("http {}".format(response.status_code))
+    return _body
+
+##
+# Operations, all called as op(options, token, account)
+
+def op_auth(options, token, account):
+    zjr.get_auth_token(options.uid, options.password, admin=True)
+
+def op_search(options, token, account):
+    _req = zjr.ZimbraJSONRequest(token, account)
+    _req.Body = zjr.SearchRequest(limit=options.limit)
+    _check(_req.request())
+
+def op_dirsearch(options, token, account):
+    _req = zjr.ZimbraJSONRequest(token, options.uid)
+    _req.Body = zjr.SearchDirectoryRequest(limit=options.limit, qtype="accounts")
+    _check(_req.request())
+
+def op_contacts(options, token, account):
+    """Creates a batch of contacts and deletes them again"""
+    _batch = zjr.CreateContactRequest()
+    for i in range(options.batch_size):
+        _contact = zjr.Contact()
+        _contact.firstName = "Load"
+        _contact.lastName = "Generator {}".format(i)
+        _batch.contact = _contact
+    _result = zjr.send_batch(token, account, _batch)
+    _ids = [cn["id"] for _, response in _result.successes for cn in response.get("cn", [])]
+    if _ids:
+        _delete = zjr.ZimbraJSONRequest(token, account)
+        _delete.Body = zjr.ContactActionRequest(",".join(_ids), action="delete")
+        _check(_delete.request())
+    if _result.faults or _result.unanswered:
+        raise OperationError("{} of {} contacts failed".format(
+            len(_result.faults) + len(_result.unanswered), options.batch_size))
+
+def op_dlmodify(options, token, account):
+    if not options.dl:
+        raise OperationError("dlmodify needs --dl")
+    _dl = zjr.DistributionList()
+    _dl.displayName = "loadgen {}".format(int(time.time()))
+    _action = zjr.DistributionListActionRequest("modify", options.dl)
+    _action.distributionlist = _dl
+    _req = zjr.ZimbraJSONRequest(token, options.uid)
+    _req.Body = _action
+    _check(_req.request())
+
+OPERATIONS = {"auth":op_auth,
+              "search":op_search,
+              "dirsearch":op_dirsearch,
+              "contacts":op_contacts,
+              "dlmodify":op_dlmodify}
+
+##
+# Mock server
+
+class DelayedTransport(zjr.iZimbraTransport):
+    """Delays every post of the wrapped transport, once per round-trip
+    no matter how many items a batch carries"""
+    def __init__(self, transport, latency):
+        self.transport = transport
+        self.latency = latency
+
+    def post(self, url, payload):
+        time.sleep(self.latency)
+        return self.transport.post(url, payload)
+
+    def clone(self):
+        return self.__class__(self.transport.clone(), self.latency)
+
+def mock_transport(latency=0.0):
+    """FakeTransport answering every operation of the load generator.
+
+    Keyword arguments:
+    latency -- seconds every request is delayed, to mimic a server
+    """
+    _ids = [0]
+    _lock = threading.Lock()
+
+    def _create_contact(request, context):
+        with _lock:
+            _ids[0] += 1
+            return {"CreateContactResponse":{"cn":[{"id":str(_ids[0])}]}}
+
+    _fake = zjr.FakeTransport()
+    for name, handler in {
+            "AuthRequest":lambda r, c: {"AuthResponse":{"authToken":[{"_content":"mock"}]}},
+            "SearchRequest":lambda r, c: {"SearchResponse":{"more":False, "cn":[]}},
+            "SearchDirectoryRequest":lambda r, c: {"SearchDirectoryResponse":{"more":False, "account":[]}},
+            "CreateContactRequest":_create_contact,
+            "ContactActionRequest":lambda r, c: {"ContactActionResponse":{"action":{}}},
+            "DistributionListActionRequest":lambda r, c: {"DistributionListActionResponse":{}},
+            }.items():
+        _fake.add_handler(name, handler)
+    if latency:
+        return DelayedTransport(_fake, latency)
+    return _fake
+
+##
+# Statistics
+
+def percentile(values, p):
+    """Nearest rank percentile of a sorted list"""
+    if not values:
+        return 0.0
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+class Stats(object):
+    """Collects latencies and errors per operation, thread safe"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._interval = {}
+        self.total = {}
+
+    def record(self, name, seconds, error=None):
+        """Records one operation. seconds is None for operations that were
+        never started, they only count as errors"""
+        with self._lock:
+            for bucket in (self._interval, self.total):
+                _latencies, _errors, _count = bucket.setdefault(name, ([], {}, [0]))
+                _count[0] += 1
+                if seconds is not None:
+                    _latencies.append(seconds)
+                if error is not None:
+                    _errors[error] = _errors.get(error, 0) + 1
+
+    def swap(self):
+        """Returns the interval collected so far and starts a new one"""
+        with self._lock:
+            _interval, self._interval = self._interval, {}
+        return _interval
+
+def summarize(bucket, seconds):
+    """Returns one line per operation and one for all of them"""
+    _lines = []
+    _all = []
+    _all_errors = 0
+    _all_count = 0
+    for name in sorted(bucket):
+        _latencies, _errors, _count = bucket[name]
+        _all.extend(_latencies)
+        _all_errors += sum(_errors.values())
+        _all_count += _count[0]
+        _lines.append(_format(name, sorted(_latencies), sum(_errors.values()), _count[0], seconds))
+    _lines.append(_format("all", sorted(_all), _all_errors, _all_count, seconds))
+    return _lines
+
+def _format(name, latencies, errors, count, seconds):
+    """ops counts every operation, ops/s only the ones that were run"""
+    return "{:<10} {:>8} ops {:>9.1f} ops/s  err {:>6.2f}%  p50 {:>8.1f}ms  p90 {:>8.1f}ms  p99 {:>8.1f}ms  max {:>8.1f}ms".format(
+        name, count, len(latencies) / seconds if seconds else 0.0,
+        100.0 * errors / count if count else 0.0,
+        percentile(latencies, 50) * 1000, percentile(latencies, 90) * 1000,
+        percentile(latencies, 99) * 1000, latencies[-1] * 1000 if latencies else 0.0)
+
+##
+# Runner
+
+def parse_mix(mix):
+    """'search=5,contacts=1' -> [("search", 5.0), ("contacts", 1.0)]"""
+    _mix = []
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError("unknown operation {}, use one of {}".format(
+                name, ", ".join(sorted(OPERATIONS))))
+        _mix.append((name, float(weight or 1)))
+    return _mix
+
+def _pick(mix, total):
+    _r = random.uniform(0, total)
+    for name, weight in mix:
+        _r -= weight
+        if _r <= 0:
+            return name
+    return mix[-1][0]
+
+def _error_name(error):
+    """Fault code or exception name, used to break the errors down"""
+    if isinstance(error, OperationError):
+        return str(error)
+    if isinstance(error, zjr.ZimbraFault):
+        return error.code
+    return error.__class__.__name__
+
+def run(options, stats, out=print):
+    """Runs the load until options.duration has passed"""
+    _mix = options.mix
+    _total_weight = sum(w for _, w in _mix)
+    _token, _ = zjr.get_auth_token(options.uid, options.password, admin=True)
+    _accounts = options.account or [options.uid]
+    _stop = threading.Event()
+    # with a target rate the workers take their work from a paced queue
+    _ticks = queue.Queue(maxsize=options.concurrency * 10) if options.rate else None
+
+    def _worker():
+        while not _stop.is_set():
+            if _ticks is not None:
+                try:
+                    # latency is measured from when the operation was due,
+                    # so time spent waiting in the queue is included
+                    _start = _ticks.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+            else:
+                _start = time.time()
+            _name = _pick(_mix, _total_weight)
+            try:
+                OPERATIONS[_name](options, _token, random.choice(_accounts))
+                stats.record(_name, time.time() - _start)
+            except Exception as e:
+                stats.record(_name, time.time() - _start, _error_name(e))
+
+    def _pacer():
+        _interval = 1.0 / options.rate
+        _next = time.time()
+        while not _stop.is_set():
+            time.sleep(max(0.0, _next - time.time()))
+            try:
+                _ticks.put_nowait(_next)
+            except queue.Full:
+                # the workers can not keep up with the target rate
+                stats.record("dropped", None, "not started")
+            _next += _interval
+
+    _threads = [threading.Thread(target=_worker) for _ in range(options.concurrency)]
+    if _ticks is not None:
+        _threads.append(threading.Thread(target=_pacer))
+    for thread in _threads:
+        thread.daemon = True
+        thread.start()
+
+    _begin = time.time()
+    _last = _begin
+    try:
+        while time.time() - _begin < options.duration:
+            time.sleep(min(options.interval, max(0.0, options.duration - (time.time() - _begin))))
+            _now = time.time()
+            out("--- {:.0f}s".format(_now - _begin))
+            for line in summarize(stats.swap(), _now - _last):
+                out(line)
+            _last = _now
+    finally:
+        _stop.set()
+        for thread in _threads:
+            thread.join()
+    return time.time() - _begin
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load generator for Zimbra, using zimbra_json_requests")
+    parser.add_argument("--url", default=settings.ZIMBRA_ADMIN_URL, help="the admin soap url")
+    parser.add_argument("--uid", default=settings.UID, help="admin account")
+    parser.add_argument("--password", default=settings.PASSWD, help="admin password")
+    parser.add_argument("--account", action="append",
+                        help="mailbox to run the mailbox operations on, can be repeated")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("search=5,dirsearch=2,contacts=1"),
+                        help="weighted operations, ie. auth=1,search=5,dirsearch=2,contacts=1,dlmodify=1")
+    parser.add_argument("--concurrency", type=int, default=8, help="number of workers")
+    parser.add_argument("--rate", type=float, default=None,
+                        help="target operations per second, default as fast as possible")
+    parser.add_argument("--duration", type=float, default=60, help="seconds to run")
+    parser.add_argument("--interval", type=float, default=5, help="seconds between reports")
+    parser.add_argument("--batch-size", type=int, default=50, help="contacts per create batch")
+    parser.add_argument("--limit", type=int, default=100, help="page size of the searches")
+    parser.add_argument("--dl", help="zimbraId of the distribution list used by dlmodify")
+    parser.add_argument("--transport", choices=["requests", "session"], default="requests")
+    parser.add_argument("--mock", action="store_true", help="run against an in-process mock server")
+    parser.add_argument("--mock-latency", type=float, default=0, help="milliseconds added by the mock")
+    options = parser.parse_args(argv)
+
+    settings.ZIMBRA_ADMIN_URL = options.url
+    if options.mock:
+        zjr.set_default_transport(mock_transport(options.mock_latency / 1000.0))
+        options.dl = options.dl or "mock"
+    elif options.transport == "session":
+        zjr.set_default_transport(zjr.RequestsTransport(session=requests.Session()))
+
+    stats = Stats()
+    _elapsed = run(options, stats)
+    print("=== total {:.0f}s".format(_elapsed))
+    for line in summarize(stats.total, _elapsed):
+        print(line)
+    for name in sorted(stats.total):
+        for error, count in sorted(stats.total[name][1].items()):
+            print("{:<10} {:>8} x {}".format(name, count, error))
+
+if __name__ == "__main__":
+    main()